@@ -20,33 +20,37 @@ def create_language_model(device, path: str=CZERT_PATH, tokenizer_path: str=None
     if not path or path == CZERT_PATH:
         tokenizer = BertTokenizerFast.from_pretrained(CZERT_PATH)
         bert = BertModel.from_pretrained(CZERT_PATH)
+        return tokenizer, bert
+
+    checkpoint = torch.load(path)
+    return create_language_model_from_checkpoint(device, checkpoint, tokenizer_path=tokenizer_path)
+
+
+def create_language_model_from_checkpoint(device, checkpoint: dict, tokenizer_path: str=None) -> Tuple[BertTokenizerFast, BertModel]:
+    if tokenizer_path:
+        tokenizer = build_tokenizer(
+            path=tokenizer_path,
+            seq_len=checkpoint["seq_len"],
+            fixed_sep=checkpoint["fixed_sep"],
+            masking_prob=0.0,
+        )
     else:
-        checkpoint = torch.load(path)
-
-        if tokenizer_path:
-            tokenizer = build_tokenizer(
-                path=tokenizer_path,
-                seq_len=checkpoint["seq_len"],
-                fixed_sep=checkpoint["fixed_sep"],
-                masking_prob=0.0,
-            )
-        else:
-            tokenizer = build_tokenizer(
-                seq_len=checkpoint["seq_len"],
-                fixed_sep=checkpoint["fixed_sep"],
-                masking_prob=0.0,
-            )
-
-        bert = build_model(
-            czert=checkpoint["czert"],
-            vocab_size=len(tokenizer),
-            device=device,
+        tokenizer = build_tokenizer(
             seq_len=checkpoint["seq_len"],
-            out_features=checkpoint["features"],
-            mlm_level=0,
-            sep=checkpoint["sep"],
+            fixed_sep=checkpoint["fixed_sep"],
+            masking_prob=0.0,
         )
-        bert.bert.load_state_dict(checkpoint["bert_state_dict"])
-        bert.nsp_head.load_state_dict(checkpoint["nsp_head_state_dict"])
+
+    bert = build_model(
+        czert=checkpoint["czert"],
+        vocab_size=len(tokenizer),
+        device=device,
+        seq_len=checkpoint["seq_len"],
+        out_features=checkpoint["features"],
+        mlm_level=0,
+        sep=checkpoint["sep"],
+    )
+    bert.bert.load_state_dict(checkpoint["bert_state_dict"])
+    bert.nsp_head.load_state_dict(checkpoint["nsp_head_state_dict"])
 
     return tokenizer, bert
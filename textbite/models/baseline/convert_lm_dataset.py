@@ -0,0 +1,79 @@
+"""Convert pickled NSP dataset into a memory-mappable format for LM fine-tuning
+
+Each split (train, val) is stored as four files:
+    <split>.bin -- int32 tokens, each row holds (input_id, token_type_id, attention_mask)
+    <split>-offsets.npy -- row offsets of the samples in <split>.bin, one more than the number of samples
+    <split>-labels.npy -- labels of the samples
+    <split>-lengths.npy -- lengths of the samples up to their last attended token
+
+Date -- 15.10.2026
+"""
+
+
+import argparse
+import os
+import logging
+import pickle
+
+import numpy as np
+
+
+SPLITS = ["train", "val"]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--logging-level", default='WARNING', choices=['ERROR', 'WARNING', 'INFO', 'DEBUG'])
+    parser.add_argument("--data", required=True, type=str, help="Path to a folder with pickle data.")
+    parser.add_argument("--save", required=True, type=str, help="Folder where to put the converted data.")
+
+    return parser.parse_args()
+
+
+def convert_split(filenames: list, data_path: str, save_path: str, split: str) -> None:
+    offsets = [0]
+    labels = []
+    lengths = []
+
+    with open(os.path.join(save_path, f"{split}.bin"), "wb") as f_out:
+        for filename in filenames:
+            logging.info(f"Converting {filename} ...")
+            with open(os.path.join(data_path, filename), "rb") as f:
+                samples = pickle.load(f)
+
+            for sample in samples:
+                tokens = np.stack([
+                    sample["input_ids"].numpy().reshape(-1),
+                    sample["token_type_ids"].numpy().reshape(-1),
+                    sample["attention_mask"].numpy().reshape(-1),
+                ], axis=1).astype(np.int32)  # Shape (seq_len, 3)
+
+                f_out.write(tokens.tobytes())
+                offsets.append(offsets[-1] + len(tokens))
+                labels.append(int(sample["label"]))
+
+                # Padding may also sit between the segments, measure up to the last attended token
+                attention_mask = tokens[:, 2]
+                lengths.append(len(attention_mask) - int(np.argmax(attention_mask[::-1])))
+
+    np.save(os.path.join(save_path, f"{split}-offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(save_path, f"{split}-labels.npy"), np.array(labels, dtype=np.int64))
+    np.save(os.path.join(save_path, f"{split}-lengths.npy"), np.array(lengths, dtype=np.int64))
+    logging.info(f"Split {split} converted, {len(labels)} samples.")
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=args.logging_level, force=True)
+
+    os.makedirs(args.save, exist_ok=True)
+
+    filenames = sorted(os.listdir(args.data))
+    for split in SPLITS:
+        split_filenames = [filename for filename in filenames if filename.startswith(split)]
+        convert_split(split_filenames, args.data, args.save, split)
+
+
+if __name__ == "__main__":
+    main()
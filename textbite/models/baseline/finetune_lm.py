@@ -6,25 +6,30 @@ Author -- Martin Kostelnik
 
 
 import argparse
+import functools
 import os
 import logging
+import math
 import pickle
+import random
 from time import perf_counter
 
+import numpy as np
 from sklearn.metrics import classification_report, f1_score
 
-from transformers import BertModel
+from transformers import BertModel, BatchEncoding
 import torch
 from safe_gpu import safe_gpu
 
-from textbite.language_model import create_language_model
+from textbite.language_model import create_language_model, create_language_model_from_checkpoint
+from textbite.utils import CZERT_PATH
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--logging-level", default='WARNING', choices=['ERROR', 'WARNING', 'INFO', 'DEBUG'])
-    parser.add_argument("--data", required=True, type=str, help="Path to a folder with pickle data.")
+    parser.add_argument("--data", required=True, type=str, help="Path to a folder with pickle data or its conversion by convert_lm_dataset.py.")
     parser.add_argument("--model", type=str, help="Path to the LM.")
     parser.add_argument("--tokenizer", type=str, help="Path to the tokenizer.")
     parser.add_argument("--save", required=True, type=str, help="Folder where to put the trained model.")
@@ -32,6 +37,7 @@ def parse_arguments():
     parser.add_argument("-e", "--epochs", type=int, default=1, help="Number of epochs")
     parser.add_argument("--lr", type=float, default=1e-3, help="Learning rate")
     parser.add_argument("--batch-size", type=int, default=16, help="Batch size")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile.")
 
     return parser.parse_args()
 
@@ -40,13 +46,96 @@ def parse_arguments():
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, data: list):
         self.data = data
+        self.lengths = [int(get_attended_lengths(sample["attention_mask"].reshape(1, -1))) for sample in data]
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, index: int):
         return self.data[index]
-    
+
+
+# Reads samples on demand from the output of convert_lm_dataset.py
+class MemmapDataset(torch.utils.data.Dataset):
+    def __init__(self, path: str, split: str):
+        self.data_path = os.path.join(path, f"{split}.bin")
+        self.offsets = np.load(os.path.join(path, f"{split}-offsets.npy"))
+        self.labels = np.load(os.path.join(path, f"{split}-labels.npy"))
+        self.lengths = np.load(os.path.join(path, f"{split}-lengths.npy")).tolist()
+        self.data = None  # Mapped lazily in each DataLoader worker
+
+    def __getstate__(self):
+        # Pickling a memmap would copy the whole file to the worker
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index: int):
+        if self.data is None:
+            self.data = np.memmap(self.data_path, dtype=np.int32, mode="r").reshape(-1, 3)
+
+        tokens = self.data[self.offsets[index]:self.offsets[index + 1]]  # Shape (seq_len, 3)
+        tokens = torch.from_numpy(tokens.astype(np.int64))
+
+        return BatchEncoding({
+            "input_ids": tokens[:, 0],
+            "token_type_ids": tokens[:, 1],
+            "attention_mask": tokens[:, 2],
+            "label": torch.tensor([self.labels[index]]),
+        })
+
+
+# Groups samples of similar lengths into batches, so that padding can be trimmed per batch
+class LengthBucketSampler(torch.utils.data.Sampler):
+    def __init__(self, lengths: list, batch_size: int, shuffle: bool, batches_per_bucket: int = 100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * batches_per_bucket
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            random.shuffle(indices)
+
+        batches = []
+        for bucket_start in range(0, len(indices), self.bucket_size):
+            bucket = indices[bucket_start:bucket_start + self.bucket_size]
+            bucket.sort(key=lambda idx: self.lengths[idx])
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        if self.shuffle:
+            random.shuffle(batches)
+
+        return iter(batches)
+
+
+def get_attended_lengths(attention_mask):
+    # Position of the last attended token, padding is not guaranteed to be a single block at the end
+    return attention_mask.size(dim=1) - attention_mask.flip(dims=[1]).argmax(dim=1)  # Shape (batch_size,)
+
+
+def collate_trimmed(samples: list, min_length: int = 0, pad_to_multiple_of: int = 16) -> BatchEncoding:
+    batch = {
+        key: torch.stack([sample[key].reshape(-1) for sample in samples])  # Shape (batch_size, seq_len)
+        for key in ("input_ids", "attention_mask", "token_type_ids")
+    }
+
+    # Trim padding not needed by any sample, round up to limit the number of distinct shapes
+    max_length = batch["attention_mask"].size(dim=1)
+    length = max(int(get_attended_lengths(batch["attention_mask"]).max()), min_length)
+    length = min(math.ceil(length / pad_to_multiple_of) * pad_to_multiple_of, max_length)
+    batch = {key: value[:, :length] for key, value in batch.items()}
+
+    batch["label"] = torch.stack([sample["label"].reshape(-1) for sample in samples])  # Shape (batch_size, 1)
+    return BatchEncoding(batch)
+
 
 class NSPModel(torch.nn.Module):
     def __init__(
@@ -77,6 +166,9 @@ class NSPModel(torch.nn.Module):
 
 
 def load_data(path: str):
+    if os.path.exists(os.path.join(path, "train.bin")):
+        return MemmapDataset(path, "train"), MemmapDataset(path, "val")
+
     filenames = os.listdir(path)
     train_data = []
     
@@ -94,9 +186,9 @@ def load_data(path: str):
 
 
 def forward(model, device, batch):
-    input_ids = batch.data["input_ids"].squeeze().to(device)
-    attention_mask = batch.data["attention_mask"].squeeze().to(device)
-    token_type_ids = batch.data["token_type_ids"].squeeze().to(device)
+    input_ids = batch.data["input_ids"].to(device, non_blocking=True)
+    attention_mask = batch.data["attention_mask"].to(device, non_blocking=True)
+    token_type_ids = batch.data["token_type_ids"].to(device, non_blocking=True)
 
     outputs = model(input_ids, attention_mask, token_type_ids)
     return outputs
@@ -115,15 +207,14 @@ def evaluate(
     all_labels = []
 
     for batch in loader:
-        labels = batch.data["label"].to(device, dtype=torch.float32)
+        labels = batch.data["label"].to(device, dtype=torch.float32, non_blocking=True)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             logits = forward(model, device, batch)
-            probs = torch.sigmoid(logits)
-            val_loss += criterion(probs, labels)
+            val_loss += criterion(logits, labels)
 
-        all_predictions.extend((probs > 0.5).cpu().squeeze())
-        all_labels.extend(labels.cpu().squeeze())
+        all_predictions.extend((logits > 0.0).cpu().squeeze(dim=1))
+        all_labels.extend(labels.cpu().squeeze(dim=1))
 
     print(f"Val loss: {val_loss/len(all_labels):.4f}")
     print(classification_report(all_labels, all_predictions, digits=4))
@@ -142,12 +233,14 @@ def train(
 ):
     model.train()
 
-    optim = torch.optim.AdamW(model.parameters(), lr)
-    criterion = torch.nn.BCELoss(reduction="sum")
+    optim = torch.optim.AdamW(model.parameters(), lr, fused=device.type == "cuda")
+    criterion = torch.nn.BCEWithLogitsLoss(reduction="sum")
 
     best_val_f1 = 0.0
     best_model_path = os.path.join(save_path, "best-nsp-lm264.pth")
 
+    use_bf16 = device.type == "cuda" and torch.cuda.is_bf16_supported()
+
     for epoch in range(epochs):
         model.train()
 
@@ -155,23 +248,27 @@ def train(
         epoch_predictions = []
 
         for batch_index, batch in enumerate(train_dataloader):
-            logits = forward(model, device, batch)
-            labels = batch.data["label"].to(device, dtype=torch.float32)
-            
-            probs = torch.sigmoid(logits)
-            train_loss = criterion(probs, labels)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                logits = forward(model, device, batch)
+            labels = batch.data["label"].to(device, dtype=torch.float32, non_blocking=True)
+
+            logits = logits.float()
+            train_loss = criterion(logits, labels)
 
-            optim.zero_grad()
+            optim.zero_grad(set_to_none=True)
             train_loss.backward()
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
             optim.step()
 
-            epoch_labels.extend(labels.cpu().squeeze().tolist())
-            epoch_predictions.extend((probs > 0.5).cpu().squeeze().tolist())
+            epoch_labels.append(labels.squeeze(dim=1))
+            epoch_predictions.append((logits.detach() > 0.0).squeeze(dim=1))
 
             if (batch_index + 1) % 100 == 0:
+                report_labels = torch.cat(epoch_labels).cpu().numpy()
+                report_predictions = torch.cat(epoch_predictions).cpu().numpy()
+
                 print("TRAIN REPORT:")
-                print(classification_report(epoch_labels, epoch_predictions, digits=4))
+                print(classification_report(report_labels, report_predictions, digits=4))
                 epoch_labels = []
                 epoch_predictions = []
 
@@ -197,11 +294,26 @@ def main():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     logging.info(f"Training on: {device}")
 
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # Model
     logging.info("Creating model ...")
-    _, bert = create_language_model(device, path=args.model, tokenizer_path=args.tokenizer)
+    # The fixed [SEP] LM is built for inputs of exactly seq_len tokens, so its batches must not be trimmed
+    min_length = 0
+    if args.model and args.model != CZERT_PATH:
+        checkpoint = torch.load(args.model)
+        _, bert = create_language_model_from_checkpoint(device, checkpoint, tokenizer_path=args.tokenizer)
+        if checkpoint["fixed_sep"]:
+            min_length = checkpoint["seq_len"]
+        del checkpoint
+    else:
+        _, bert = create_language_model(device, path=args.model, tokenizer_path=args.tokenizer)
     model = NSPModel(device, bert)
     model = model.to(device)
+    if args.compile:
+        # Batches are trimmed to a multiple of 16 tokens, so only a few CUDA graphs are captured
+        model = torch.compile(model, mode="reduce-overhead")
     logging.info("Model created.")
 
     # Data
@@ -210,8 +322,27 @@ def main():
     logging.info("Data loaded.")
 
     logging.info("Creating dataloaders ...")
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
-    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size)
+    # Batches are BatchEncoding mappings, which the default pin_memory handles key by key
+    num_workers = min(8, os.cpu_count() or 1)
+    collate_fn = functools.partial(collate_trimmed, min_length=min_length)
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_sampler=LengthBucketSampler(train_dataset.lengths, args.batch_size, shuffle=True),
+        collate_fn=collate_fn,
+        pin_memory=device.type == "cuda",
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=4,
+    )
+    val_loader = torch.utils.data.DataLoader(
+        val_dataset,
+        batch_sampler=LengthBucketSampler(val_dataset.lengths, args.batch_size, shuffle=False),
+        collate_fn=collate_fn,
+        pin_memory=device.type == "cuda",
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=4,
+    )
     logging.info("Loaders created.")
 
     # Output folders
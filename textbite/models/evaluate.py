@@ -6,11 +6,13 @@ Author -- Martin Kostelnik
 
 
 import argparse
+import itertools
 import json
 import logging
 import os
 import sys
 
+import numpy as np
 import sklearn.metrics
 
 from textbite.utils import get_line_clusters
@@ -32,7 +34,7 @@ def parse_arguments():
 
 def score_page(hypothesis, ground_truth):
     hypothesis = [bite["lines"] for bite in hypothesis]
-    line_ids = sum(hypothesis, []) + sum(ground_truth, [])
+    line_ids = list(itertools.chain.from_iterable(hypothesis + ground_truth))
 
     ground_truth = [{"lines": lines} for lines in ground_truth]
     hypothesis = [{"lines": lines} for lines in hypothesis]
@@ -40,8 +42,8 @@ def score_page(hypothesis, ground_truth):
     hyp_lines_clusters = get_line_clusters(hypothesis)
     gt_lines_clusters = get_line_clusters(ground_truth)
 
-    hyp = [hyp_lines_clusters.get(line_id, -1) for line_id in line_ids]
-    gt = [gt_lines_clusters.get(line_id, -1) for line_id in line_ids]
+    hyp = np.fromiter((hyp_lines_clusters.get(line_id, -1) for line_id in line_ids), dtype=np.int32, count=len(line_ids))
+    gt = np.fromiter((gt_lines_clusters.get(line_id, -1) for line_id in line_ids), dtype=np.int32, count=len(line_ids))
 
     return sklearn.metrics.homogeneity_completeness_v_measure(hyp, gt)
 
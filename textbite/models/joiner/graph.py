@@ -34,7 +34,15 @@ class Graph:
         self.node_features = torch.stack(node_features)  # Shape (n_nodes, n_features)
         self.edge_index = torch.tensor([from_indices, to_indices], dtype=torch.int64)  # Shape (2, n_edges)
         self.edge_attr = torch.stack(edge_attr)  # Shape (n_edges, n_features)
-        self.labels = torch.tensor(labels)  # Shape (1, n_edges)
+        self.labels = torch.tensor(labels, dtype=torch.float32)  # Shape (1, n_edges)
+
+    def to(self, device) -> "Graph":
+        self.node_features = self.node_features.to(device, non_blocking=True)
+        self.edge_index = self.edge_index.to(device, non_blocking=True)
+        self.edge_attr = self.edge_attr.to(device, non_blocking=True)
+        self.labels = self.labels.to(device, dtype=torch.float32, non_blocking=True)  # Graphs pickled with int64 labels
+
+        return self
 
     def flatten(self) -> Tuple[List[torch.FloatTensor], List[float], List[Tuple[int, int]]]:
         edge_list = []
@@ -8,7 +8,6 @@ Author -- Martin Kostelnik
 import sys
 import os
 import argparse
-import itertools
 import logging
 from typing import Tuple, List
 from time import perf_counter
@@ -22,7 +21,7 @@ from safe_gpu import safe_gpu
 
 from textbite.models.joiner.model import JoinerGraphModel
 from textbite.models.joiner.graph import Graph  # needed for unpickling
-from textbite.models.utils import get_similarities, GraphNormalizer, load_graphs
+from textbite.models.utils import get_similarity_logits, GraphNormalizer, load_graphs
 
 
 def parse_arguments():
@@ -43,6 +42,7 @@ def parse_arguments():
 
     parser.add_argument("--lr", type=float, default=1e-3, help="Learning rate")
     parser.add_argument("--batch-size", type=int, default=16, help="Batch size")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile.")
 
     parser.add_argument("--report-interval", type=int, default=10, help="After how many updates to report")
     parser.add_argument("--save", type=str, help="Where to save the model best by validation F1")
@@ -53,7 +53,7 @@ def parse_arguments():
 
 
 def collate_custom_graphs(graphs):
-    multi_graph = copy.deepcopy(graphs[0])
+    multi_graph = copy.copy(graphs[0])  # All tensors get replaced below, no need to copy them
 
     multi_graph.id = None  # We don't guarantee this makes any sense
     multi_graph.node_features = torch.concatenate([g.node_features for g in graphs])  # Shape (n_nodes, n_features)
@@ -72,6 +72,11 @@ def collate_custom_graphs(graphs):
     return multi_graph
 
 
+def iterate_forever(loader):
+    while True:
+        yield from loader
+
+
 class TrainingMonitor:
     def __init__(self):
         self.train_losses = []
@@ -110,19 +115,19 @@ def evaluate(model, data, device, criterion, type: str, threshold: float) -> Tup
     all_labels = []
 
     for graph in data:
-        node_features = graph.node_features.to(device)
-        edge_indices = graph.edge_index.to(device)
-        labels = graph.labels.to(device, dtype=torch.float32)
-        edge_attrs = graph.edge_attr.to(device)
+        node_features = graph.node_features
+        edge_indices = graph.edge_index
+        labels = graph.labels
+        edge_attrs = graph.edge_attr
 
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = model(node_features, edge_indices, edge_attrs)
-            similarities = get_similarities(outputs, edge_indices)
-            loss = criterion(similarities, labels)
+            logits = get_similarity_logits(outputs, edge_indices)
+            loss = criterion(logits, labels)
 
         val_loss += loss.cpu().item()        
         all_labels.extend(labels.cpu().tolist())
-        all_similarities.extend(similarities.cpu().tolist())
+        all_similarities.extend(torch.sigmoid(logits).cpu().tolist())
 
     all_predictions = [int(similarity > threshold) for similarity in all_similarities]
 
@@ -150,69 +155,74 @@ def train(
 
     monitor = TrainingMonitor()
 
-    optim = torch.optim.AdamW(model.parameters(), lr)
+    optim = torch.optim.AdamW(model.parameters(), lr, fused=device.type == "cuda")
     # criterion = torch.nn.BCEWithLogitsLoss(reduction="sum", pos_weight=torch.tensor([0.01]).to(device))
-    # criterion = torch.nn.BCEWithLogitsLoss()
-    criterion = torch.nn.BCELoss()
+    criterion = torch.nn.BCEWithLogitsLoss()
 
     running_loss = 0.0
     best_precision_sum = 0.0
-    batch = []
     batch_id = 0
 
-    all_similarities = []
+    all_logits = []
     all_labels = []
 
     best_model_path = os.path.join(save_path, "best-gcn-joiner.pth")
     last_model_path = os.path.join(save_path, "last-gcn-joiner.pth")
 
+    use_bf16 = device.type == "cuda" and torch.cuda.is_bf16_supported()
+
+    assert len(train_data) >= batch_size, "Not enough training graphs to fill a single batch"
+    train_loader = torch.utils.data.DataLoader(
+        train_data,
+        batch_size=batch_size,
+        shuffle=True,
+        drop_last=True,
+        collate_fn=collate_custom_graphs,
+    )
+
     t_start = perf_counter()
     try:
-        for graph_i, graph in enumerate(itertools.cycle(train_data)):
-            batch.append(graph)
-            if len(batch) < batch_size:
-                continue
-
+        for graph in iterate_forever(train_loader):
             model.train()
-            graph = collate_custom_graphs(batch)
-            batch = []
             batch_id += 1
 
-            node_features = graph.node_features.to(device)
-            edge_indices = graph.edge_index.to(device)
-            edge_attrs = graph.edge_attr.to(device)
-            labels = graph.labels.to(device, dtype=torch.float32)
+            node_features = graph.node_features
+            edge_indices = graph.edge_index
+            edge_attrs = graph.edge_attr
+            labels = graph.labels
 
-            outputs = model(node_features, edge_indices, edge_attrs)
-            similarities = get_similarities(outputs, edge_indices)
-            train_loss = criterion(similarities, labels)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                outputs = model(node_features, edge_indices, edge_attrs)
+            logits = get_similarity_logits(outputs.float(), edge_indices)
+            train_loss = criterion(logits, labels)
 
-            optim.zero_grad()
+            optim.zero_grad(set_to_none=True)
             train_loss.backward()
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
             optim.step()
 
-            running_loss += train_loss.cpu().item()
-            all_similarities.extend(similarities.cpu().tolist())
-            all_labels.extend(labels.cpu().tolist())
+            running_loss += train_loss.detach()
+            all_logits.append(logits.detach())
+            all_labels.append(labels)
 
             if batch_id % report_interval == 0:
-                t_elapsed_ms = 1000.0 * (perf_counter() - t_start) / report_interval
+                report_predictions = (torch.sigmoid(torch.cat(all_logits)) > threshold).int().cpu().numpy()
+                report_labels = torch.cat(all_labels).cpu().numpy()
+                loss = running_loss.item() / report_interval
 
-                all_predictions = [int(similarity > threshold) for similarity in all_similarities]
+                t_elapsed_ms = 1000.0 * (perf_counter() - t_start) / report_interval
 
                 print("TRAIN REPORT:")
-                print(f"After {batch_id} Batches ({graph_i + 1} Graphs):")
+                print(f"After {batch_id} Batches ({batch_id * batch_size} Graphs):")
                 print(f"Time {t_elapsed_ms:.1f} ms /B ", end="")
                 print(f"({(t_elapsed_ms / batch_size):.1f} ms /G) | ", end="")
-                loss = (running_loss / report_interval)
                 print(f"loss {loss:.4f} /G")
-                print(classification_report(all_labels, all_predictions, digits=4))
+                print(classification_report(report_labels, report_predictions, digits=4))
 
                 monitor.train_losses.append(loss)
 
                 running_loss = 0.0
-                all_similarities = []
+                all_logits = []
                 all_labels = []
 
                 print("EVALUATION REPORT:")
@@ -268,6 +278,9 @@ def main():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     logging.info(f"Training on: {device}")
 
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # Data
     logging.info("Loading data ...")
     train_graphs, val_graphs_book, val_graphs_dict, val_graphs_peri = load_graphs(args.train, args.val_book, args.val_dict, args.val_peri)
@@ -286,6 +299,18 @@ def main():
     normalizer.normalize_graphs(val_graphs_peri)
     logging.info("Train and validation data normalized.")
 
+    # Graphs are static, keep them on the device instead of copying them for every batch and evaluation
+    logging.info("Moving train and validation data to device ...")
+    all_graphs = train_graphs + val_graphs_book + val_graphs_dict + val_graphs_peri
+    data_size = sum(
+        t.element_size() * t.nelement()
+        for g in all_graphs
+        for t in (g.node_features, g.edge_index, g.edge_attr, g.labels)
+    )
+    for graph in all_graphs:
+        graph.to(device)
+    logging.info(f"Train and validation data moved to device ({data_size / 2**20:.1f} MiB).")
+
     # Output folders
     os.makedirs(args.save, exist_ok=True)
 
@@ -309,6 +334,9 @@ def main():
     )
     print(model)
     model = model.to(device)
+    if args.compile:
+        # Batched graphs differ in the number of nodes and edges, avoid recompiling for each of them
+        model = torch.compile(model, dynamic=True)
     logging.info("Model created.")
 
     logging.info("Starting training ...")
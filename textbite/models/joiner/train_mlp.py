@@ -82,19 +82,18 @@ def evaluate(
     for graph in data:
         graph_features, graph_labels, _ = graph.flatten()
 
-        for edge_features, label in zip(graph_features, graph_labels):
-            edge_features = edge_features.to(device)
-            label = torch.tensor(label, dtype=torch.float32).to(device)
+        edge_features = torch.stack(graph_features).to(device)  # Shape (n_edges, n_features)
+        labels = torch.tensor(graph_labels, dtype=torch.float32).to(device)  # Shape (n_edges,)
 
-            with torch.no_grad():
-                logits = model(edge_features).squeeze()
+        with torch.inference_mode():
+            logits = model(edge_features).squeeze(dim=1)
 
-            probs = torch.sigmoid(logits)
-            val_loss += criterion(probs, label)
+        probs = torch.sigmoid(logits)
+        val_loss += criterion(probs, labels)
+
+        all_predictions.extend((probs > threshold).cpu().tolist())
+        all_labels.extend(labels.cpu().tolist())
 
-            all_predictions.append((probs > threshold).cpu().item())
-            all_labels.append(label.cpu().item())
-    
     print(f"Val loss {type}: {val_loss/len(all_labels):.4f}")
     print(classification_report(all_labels, all_predictions, digits=4))
 
@@ -57,12 +57,14 @@ def get_transitive_subsets(positive_edges: List[Tuple[int, int]]) -> List[Set[Tu
     return positive_subsets
 
 
-def get_similarities(node_features, edge_indices):
+def get_similarity_logits(node_features, edge_indices):
     lhs_nodes = torch.index_select(input=node_features, dim=0, index=edge_indices[0, :])
     rhs_nodes = torch.index_select(input=node_features, dim=0, index=edge_indices[1, :])
-    similarities = torch.cosine_similarity(lhs_nodes, rhs_nodes, dim=1)
-    similarities = torch.sigmoid(similarities)
-    return similarities
+    return torch.cosine_similarity(lhs_nodes, rhs_nodes, dim=1)
+
+
+def get_similarities(node_features, edge_indices):
+    return torch.sigmoid(get_similarity_logits(node_features, edge_indices))
 
 
 class GraphNormalizer: